@@ -26,6 +26,7 @@ import sys
 from pathlib import Path
 
 import pypiserver
+from pypiserver import bottle_wrapper
 from pypiserver_metrics_plugin import MetricsPlugin
 
 
@@ -99,7 +100,8 @@ Examples:
     # Install metrics plugin
     logger.info(f"Installing metrics plugin (endpoint: {metrics_endpoint})...")
     try:
-        app.install(MetricsPlugin(metrics_endpoint=metrics_endpoint))
+        metrics_plugin = MetricsPlugin(metrics_endpoint=metrics_endpoint)
+        app.install(metrics_plugin)
         logger.info("✓ Metrics plugin installed successfully")
     except Exception as e:
         logger.error(f"✗ Failed to install metrics plugin: {e}")
@@ -115,9 +117,14 @@ Examples:
     print("=" * 60)
     print("\nPress Ctrl+C to stop the server\n")
 
-    # Run server
+    # Run server, serving the metrics endpoint ahead of Bottle
     try:
-        app.run(host=args.host, port=args.port, debug=args.verbose)
+        bottle_wrapper.run(
+            app=metrics_plugin.wsgi_middleware(app),
+            host=args.host,
+            port=args.port,
+            debug=args.verbose,
+        )
     except KeyboardInterrupt:
         print("\n\nShutting down server...")
         sys.exit(0)
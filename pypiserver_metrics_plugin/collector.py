@@ -1,4 +1,6 @@
+import threading
 import time
+from typing import Optional, Sequence
 
 from prometheus_client import (
     Counter,
@@ -10,6 +12,18 @@ from prometheus_client import (
     CONTENT_TYPE_LATEST,
 )
 
+# Default upper bounds of the HTTP request duration histogram buckets,
+# from fast file serves to slow uploads (+Inf is implied)
+_HTTP_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+# Valid `error_type` label values of pypiserver_errors_total:
+# - upload_failed: a POST to the update endpoint (/) was rejected
+# - auth_failed: the request was not authenticated or not authorized
+# - not_found: the requested package, project or page does not exist
+# - internal: the server failed to handle the request
+# Anything else is recorded as "other".
+_ERROR_TYPES = frozenset({"upload_failed", "auth_failed", "not_found", "internal"})
+
 
 class MetricsCollector:
     """
@@ -19,7 +33,17 @@ class MetricsCollector:
     (all metric recording becomes a no-op).
     """
 
-    def __init__(self) -> None:
+    def __init__(self, buckets: Optional[Sequence[float]] = None) -> None:
+        """
+        Initialize the metrics collector.
+
+        Args:
+            buckets: Upper bounds of the HTTP request duration histogram
+                buckets, +Inf is implied (default: _HTTP_DURATION_BUCKETS)
+        """
+        if buckets is None:
+            buckets = _HTTP_DURATION_BUCKETS
+
         # Create a separate registry for pypiserver metrics
         self.registry = CollectorRegistry()
 
@@ -35,37 +59,15 @@ class MetricsCollector:
             "pypiserver_http_request_duration_seconds",
             "HTTP request duration in seconds",
             ["method", "endpoint", "status_code"],
-            buckets=[
-                0.005,
-                0.01,
-                0.025,
-                0.05,
-                0.075,
-                0.1,
-                0.25,
-                0.5,
-                0.75,
-                1.0,
-                2.5,
-                5.0,
-                7.5,
-                10.0,
-            ],
+            buckets=buckets,
             registry=self.registry,
         )
 
         # Package Operation Metrics
-        self.package_downloads_total = Counter(
-            "pypiserver_package_downloads_total",
-            "Total package downloads",
-            ["package_name", "filename"],
-            registry=self.registry,
-        )
-
-        self.package_uploads_total = Counter(
-            "pypiserver_package_uploads_total",
-            "Total successful package uploads",
-            ["package_name", "user"],
+        self.package_ops_total = Counter(
+            "pypiserver_package_ops_total",
+            "Total package downloads, uploads and removals",
+            ["op", "package_name", "principal"],
             registry=self.registry,
         )
 
@@ -76,13 +78,6 @@ class MetricsCollector:
             registry=self.registry,
         )
 
-        self.package_removals_total = Counter(
-            "pypiserver_package_removals_total",
-            "Total package removals",
-            ["package_name", "user"],
-            registry=self.registry,
-        )
-
         # Repository State Metrics
         self.packages_total = Gauge(
             "pypiserver_packages_total",
@@ -140,29 +135,105 @@ class MetricsCollector:
             registry=self.registry,
         )
 
+        # Label-bound children, resolved once per unique label combination
+        self._http_req_children: dict[tuple, tuple[Counter, Histogram]] = {}
+        self._package_op_children: dict[tuple, Counter] = {}
+        self._simple_index_children: dict[str, Counter] = {}
+
+        # Projects known to the repository, for incremental project counts
+        self._projects: set[str] = set()
+        # Package files known to the repository, only tracked when uploads
+        # may overwrite existing files (None otherwise)
+        self._files: Optional[set[str]] = None
+        # Guards the sets above and the repository state gauges, which are
+        # updated from several worker threads and from backend walks
+        self._repository_lock = threading.Lock()
+
     def record_http_request(
             self, method: str, endpoint: str, status_code: int, duration: float
     ) -> None:
         """Record an HTTP request with timing."""
-        self.http_requests_total.labels(
-            method=method, endpoint=endpoint, status_code=status_code
-        ).inc()
+        counter, histogram = self._http_request_children(
+            method, endpoint, status_code
+        )
+        counter.inc()
+        histogram.observe(duration)
+
+    def record_http_requests(
+            self,
+            method: str,
+            endpoint: str,
+            status_code: str,
+            durations: list[float],
+    ) -> None:
+        """Record a batch of HTTP requests sharing the same labels."""
+        counter, histogram = self._http_request_children(
+            method, endpoint, status_code
+        )
+        counter.inc(len(durations))
+        for duration in durations:
+            histogram.observe(duration)
+
+    def _http_request_children(
+            self, method: str, endpoint: str, status_code: str
+    ) -> tuple[Counter, Histogram]:
+        """Return the (counter, histogram) children for the given labels."""
+        key = (method, endpoint, status_code)
+        children = self._http_req_children.get(key)
+        if children is None:
+            children = (
+                self.http_requests_total.labels(*key),
+                self.http_request_duration_seconds.labels(*key),
+            )
+            self._http_req_children[key] = children
+        return children
+
+    def record_download(
+            self,
+            package_name: str,
+            filename: Optional[str] = None,
+            user: Optional[str] = None,
+    ) -> None:
+        """
+        Record a package download.
 
-        self.http_request_duration_seconds.labels(
-            method=method, endpoint=endpoint, status_code=status_code
-        ).observe(duration)
+        `filename` is accepted for backwards compatibility only; it is no
+        longer used as a label.
+        """
+        self._record_package_op("download", package_name, user)
 
-    def record_download(self, package_name: str, filename: str) -> None:
-        """Record a package download."""
-        self.package_downloads_total.labels(
-            package_name=package_name, filename=filename
-        ).inc()
+    def record_upload(
+            self,
+            package_name: str,
+            user: str,
+            filename: Optional[str] = None,
+    ) -> None:
+        """
+        Record a successful package upload.
+
+        Also counts the uploaded file (and its project) in the repository
+        state metrics if they are new. When files are tracked (see
+        reset_repository_state()), re-uploads of a known `filename` (e.g.
+        with --overwrite) leave the counts unchanged.
+
+        Args:
+            package_name: Normalized name of the uploaded project
+            user: Uploading user, or None for anonymous uploads
+            filename: Path of the stored file relative to its package root,
+                as passed to reset_repository_state() in `files`
+        """
+        self._record_package_op("upload", package_name, user)
 
-    def record_upload(self, package_name: str, user: str) -> None:
-        """Record a successful package upload."""
-        self.package_uploads_total.labels(
-            package_name=package_name, user=user or "anonymous"
-        ).inc()
+        with self._repository_lock:
+            if self._files is not None and filename is not None:
+                if filename in self._files:
+                    return
+                self._files.add(filename)
+
+            self.packages_total.inc()
+            if package_name not in self._projects:
+                self._projects.add(package_name)
+                self.projects_total.inc()
 
     def record_upload_failure(self, reason: str) -> None:
         """Record a failed package upload."""
@@ -170,26 +241,61 @@ class MetricsCollector:
 
     def record_removal(self, package_name: str, user: str) -> None:
         """Record a package removal."""
-        self.package_removals_total.labels(
-            package_name=package_name, user=user or "anonymous"
-        ).inc()
-
-    def update_package_counts(
+        self._record_package_op("remove", package_name, user)
+
+    def _record_package_op(self, op: str, package_name: str, user: str) -> None:
+        """Record a package operation performed by the given user."""
+        key = (op, package_name, user or "anonymous")
+        child = self._package_op_children.get(key)
+        if child is None:
+            child = self.package_ops_total.labels(*key)
+            self._package_op_children[key] = child
+        child.inc()
+
+    def _update_package_counts(
             self, package_count: int, project_count: int
     ) -> None:
-        """Update repository state metrics."""
+        """
+        Update repository state metrics.
+
+        Private, as the counts must stay in sync with the incremental
+        state; use reset_repository_state() instead.
+        """
         self.packages_total.set(package_count)
         self.projects_total.set(project_count)
 
+    def reset_repository_state(
+            self,
+            package_count: int,
+            projects: set[str],
+            files: Optional[set[str]] = None,
+    ) -> None:
+        """
+        Reset repository state metrics from a full walk of the backend.
+
+        Args:
+            package_count: Number of package files
+            projects: Names of all projects
+            files: Paths of all package files relative to their root, used
+                to tell new uploads from re-uploads. Only needed when uploads
+                may overwrite existing files; None stops tracking them.
+        """
+        with self._repository_lock:
+            self._projects = projects
+            self._files = files
+            self._update_package_counts(package_count, len(projects))
+
     def record_search(self, search_type: str) -> None:
         """Record a search operation."""
         self.searches_total.labels(search_type=search_type).inc()
 
     def record_simple_index_request(self, project_name: str) -> None:
         """Record a PEP 503 simple index request."""
-        self.simple_index_requests_total.labels(
-            project_name=project_name
-        ).inc()
+        child = self._simple_index_children.get(project_name)
+        if child is None:
+            child = self.simple_index_requests_total.labels(project_name)
+            self._simple_index_children[project_name] = child
+        child.inc()
 
     def record_auth_attempt(self, action: str, success: bool) -> None:
         """Record an authentication attempt."""
@@ -199,7 +305,15 @@ class MetricsCollector:
     def record_error(
             self, endpoint: str, error_type: str, status_code: int
     ) -> None:
-        """Record an error."""
+        """
+        Record an error.
+
+        Unknown error types are recorded as "other" so that the
+        label stays bounded.
+        """
+        if error_type not in _ERROR_TYPES:
+            error_type = "other"
+
         self.errors_total.labels(
             endpoint=endpoint, error_type=error_type, status_code=status_code
         ).inc()
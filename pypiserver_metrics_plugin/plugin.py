@@ -1,8 +1,80 @@
+import functools
+import gzip
+import logging
 import os
+import queue
+import sys
+import threading
 import time
 
+from pypiserver.bottle_wrapper import HTTPResponse, RouteReset, request, response
+from pypiserver.pkg_helpers import guess_pkgname_and_version, normalize_pkgname
+
 from .collector import MetricsCollector
 
+logger = logging.getLogger(__name__)
+
+# Pre-built status code label values for the responses pypiserver commonly sends
+_COMMON_STATUS = {
+    code: str(code)
+    for code in (
+        200, 201, 204, 301, 302, 303, 304, 400, 401, 403, 404, 405, 409, 413,
+        500, 502, 503,
+    )
+}
+
+# Content types of POST bodies that may carry an upload or removal
+_FORM_CONTENT_TYPES = ("multipart/form-data", "application/x-www-form-urlencoded")
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_project_of(filename):
+    """
+    Return the PEP 503 normalized project name of a package filename.
+
+    Results are cached, since popular files are requested over and over.
+    """
+    pkg_info = guess_pkgname_and_version(filename)
+    return normalize_pkgname(pkg_info[0]) if pkg_info else None
+
+
+class _PendingMetrics:
+    """
+    HTTP request observations buffered between two flushes.
+
+    Observations are grouped by their (method, endpoint, status_code)
+    labels so that a flush touches each metric child only once.
+    """
+
+    def __init__(self):
+        self.durations: dict[tuple, list[float]] = {}
+        self.size = 0
+
+    def add(self, key: tuple, duration: float) -> None:
+        """Buffer a single observation."""
+        durations = self.durations.get(key)
+        if durations is None:
+            self.durations[key] = [duration]
+        else:
+            durations.append(duration)
+        self.size += 1
+
+
+class _ScrapeOutput:
+    """Generated metrics output, shared by scrapes within scrape_cache_ttl."""
+
+    def __init__(self, body: bytes, content_type: str):
+        self.generated_at = time.monotonic()
+        self.body = body
+        self.content_type = content_type
+        self._gzipped = None
+
+    def gzipped(self) -> bytes:
+        """Return the gzip-compressed body, compressing it on first use."""
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=1)
+        return self._gzipped
+
 
 class MetricsPlugin:
     """
@@ -11,7 +83,8 @@ class MetricsPlugin:
     This plugin is completely self-contained and non-invasive. It:
     - Tracks HTTP requests via Bottle hooks
     - Auto-detects package operations (downloads, uploads, searches) from request patterns
-    - Provides a /metrics endpoint for Prometheus scraping
+    - Provides a /metrics endpoint for Prometheus scraping, optionally served
+      ahead of Bottle by wsgi_middleware()
     - Requires NO changes to route handlers
 
     Usage:
@@ -22,17 +95,66 @@ class MetricsPlugin:
     name = 'metrics'
     api = 2
 
-    def __init__(self, metrics_endpoint="/metrics", **kwargs):
+    def __init__(
+            self,
+            metrics_endpoint="/metrics",
+            aggregate_observations=True,
+            flush_threshold=200,
+            queue_size=256,
+            workers=1,
+            stats_refresh_interval=None,
+            scrape_cache_ttl=1.0,
+            buckets=None,
+            **kwargs,
+    ):
         """
         Initialize the metrics plugin.
 
         Args:
             metrics_endpoint: Path for the metrics endpoint (default: /metrics)
+            aggregate_observations: Buffer HTTP request observations and
+                apply them to the collector in batches (default: True)
+            flush_threshold: Number of buffered observations that triggers
+                a flush (default: 200). The buffers are also flushed whenever
+                the scrape output is regenerated; events still queued for
+                the workers are not included.
+            queue_size: Maximum number of request events waiting to be
+                recorded (default: 256). Events are dropped when it is full.
+            workers: Number of threads recording request events (default: 1)
+            stats_refresh_interval: Seconds between full walks of the
+                backend correcting package and project counts (default: None,
+                counts are only walked at startup and after removals and are
+                otherwise updated from observed uploads). Walks run on a
+                background thread, never on the response path or the workers.
+            scrape_cache_ttl: Seconds for which the generated metrics output
+                is served to subsequent scrapes (default: 1.0)
+            buckets: Upper bounds of the HTTP request duration histogram
+                buckets (default: 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
             **kwargs: Additional keyword arguments (for future extensibility)
         """
         self.metrics_endpoint = os.getenv("METRICS_ENDPOINT", metrics_endpoint)
+        self.aggregate_observations = aggregate_observations
+        self.flush_threshold = flush_threshold
+        self.queue_size = queue_size
+        self.workers = workers
+        self.stats_refresh_interval = stats_refresh_interval
+        self.scrape_cache_ttl = scrape_cache_ttl
+        self.buckets = buckets
         self.config = None
         self.collector = None
+        # One buffer per worker thread, so workers never contend on a lock;
+        # the shards are merged into the collector when flushed
+        self._pending = [_PendingMetrics() for _ in range(workers)]
+        self._pending_locks = [threading.Lock() for _ in range(workers)]
+        self._events = None
+        self._threads = []
+        self._stats_lock = threading.Lock()
+        self._stats_stop = threading.Event()
+        # Set to request a walk of the backend from the stats thread
+        self._stats_walk = threading.Event()
+        self._stats_thread = None
+        self._scrape_lock = threading.Lock()
+        self._scrape_output = None
 
     def setup(self, app):
         """
@@ -41,8 +163,13 @@ class MetricsPlugin:
         This method:
         - Extracts pypiserver config from the app
         - Initializes the metrics collector
-        - Adds before_request and after_request hooks
         - Registers the /metrics endpoint
+        - Adds before_request and after_request hooks
+        - Walks the backend for the initial package and project counts
+        - Starts the worker threads recording request events
+
+        Threads are started last, so that a failed setup (e.g. a conflicting
+        metrics endpoint) leaves none behind.
         """
         from pypiserver import __version__
 
@@ -57,7 +184,7 @@ class MetricsPlugin:
             )
 
         # Initialize metrics collector
-        self.collector = MetricsCollector()
+        self.collector = MetricsCollector(buckets=self.buckets)
 
         # Set server info
         self.collector.set_server_info(
@@ -66,80 +193,257 @@ class MetricsPlugin:
             fallback_url=getattr(self.config, 'fallback_url', None) or "none",
         )
 
+        # Add metrics endpoint
+        self._add_metrics_endpoint(app)
+
         # Add hooks for tracking requests
         app.add_hook('before_request', self._before_request)
         app.add_hook('after_request', self._after_request)
 
-        # Add metrics endpoint
-        self._add_metrics_endpoint(app)
+        # Initial package and project counts, kept up to date incrementally
+        # and re-walked by the stats thread after removals and periodically
+        self._update_repository_stats()
+        self._stats_thread = threading.Thread(
+            target=self._refresh_repository_stats,
+            name="pypiserver-metrics-stats",
+            daemon=True,
+        )
+        self._stats_thread.start()
+
+        # Start workers recording request events off the response path
+        self._events = queue.Queue(maxsize=self.queue_size)
+        self._threads = [
+            threading.Thread(
+                target=self._drain,
+                args=(i,),
+                name=f"pypiserver-metrics-{i}",
+                daemon=True,
+            )
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
 
     def _before_request(self):
         """Hook called before each request to start timing."""
-        from pypiserver.bottle_wrapper import request
-        request._metrics_start_time = time.time()
+        # Scrapes of the metrics endpoint are not recorded themselves. The
+        # flag is reset here because a RouteReset re-dispatches the request
+        # with the same environ.
+        request._metrics_skip = request.path == self.metrics_endpoint
+        if not request._metrics_skip:
+            request._metrics_start_time = time.monotonic()
 
     def _after_request(self):
-        """Hook called after each request to record metrics."""
-        from pypiserver.bottle_wrapper import request, response
+        """
+        Hook called after each request to record metrics.
 
-        if not self.collector:
+        Only the request attributes needed for recording are captured here;
+        the event is handed over to the worker threads so that parsing and
+        metric updates stay off the response path.
+        """
+        if not self.collector or getattr(request, "_metrics_skip", False):
             return
 
-        duration = time.time() - getattr(request, "_metrics_start_time", time.time())
-        endpoint = request.path
+        start = getattr(request, "_metrics_start_time", None)
+        duration = 0.0 if start is None else time.monotonic() - start
+        path = request.path
         method = request.method
-        status_code = str(response.status_code)
+
+        # Bottle applies HTTPResponse objects raised or returned by handlers
+        # to the response only after this hook, so take their status first:
+        # from apply()'s wrapper for route handlers (including 500 for
+        # crashes), and from the in-flight exception for router errors
+        # (404/405). Other exceptions seen here may merely be handled, e.g.
+        # the RouteReset a re-dispatched request runs under.
+        code = getattr(request, "_metrics_status_code", None)
+        if code is None:
+            error = sys.exc_info()[1]
+            if isinstance(error, HTTPResponse):
+                code = error.status_code
+            else:
+                code = response.status_code
+        status_code = _COMMON_STATUS.get(code) or str(code)
+
+        # Only form POSTs can be uploads or removals; other bodies are never
+        # parsed just for the sake of metrics
+        action = raw_filename = project = user = None
+        if method == "GET" and path.startswith("/packages/"):
+            user = request.auth[0] if request.auth else "anonymous"
+        elif (
+                method == "POST"
+                and path == "/"
+                and status_code == "200"
+                and request.content_type.startswith(_FORM_CONTENT_TYPES)
+        ):
+            action = request.forms.get(":action", "")
+            if action == "file_upload":
+                uploaded_file = request.files.get("content")
+                if uploaded_file:
+                    raw_filename = uploaded_file.raw_filename
+            elif action == "remove_pkg":
+                project = request.forms.get("name")
+            user = request.auth[0] if request.auth else "anonymous"
+
+        try:
+            self._events.put_nowait(
+                (
+                    method, path, status_code, duration, action, raw_filename,
+                    project, user,
+                )
+            )
+        except queue.Full:
+            # Metric updates must never block the response; drop the event
+            pass
+
+    def _drain(self, shard):
+        """Worker loop recording queued request events into its own shard."""
+        while True:
+            event = self._events.get()
+            if event is None:
+                self._events.task_done()
+                return
+
+            try:
+                self._record_event(shard, *event)
+            except Exception as e:
+                # Metrics collection shouldn't kill the worker
+                logger.warning(f"Failed to record request metrics: {e}")
+            finally:
+                self._events.task_done()
+
+    def _record_event(
+            self, shard, method, path, status_code, duration, action,
+            raw_filename, project, user
+    ):
+        """Record metrics for a single request event."""
+        endpoint = self._route_of(path)
 
         # Record HTTP request metrics
-        self.collector.record_http_request(
-            method=method,
-            endpoint=endpoint,
-            status_code=status_code,
-            duration=duration,
-        )
+        if self.aggregate_observations:
+            self._buffer_http_request(
+                shard, method, endpoint, status_code, duration
+            )
+        else:
+            self.collector.record_http_request(
+                method=method,
+                endpoint=endpoint,
+                status_code=status_code,
+                duration=duration,
+            )
 
         # Auto-detect and record application-specific metrics based on patterns
-        self._record_application_metrics(request, response, status_code)
+        self._record_application_metrics(
+            method, path, status_code, action, raw_filename, project, user
+        )
+
+        if int(status_code) >= 400:
+            self.collector.record_error(
+                endpoint=endpoint,
+                error_type=self._error_type_of(method, path, status_code),
+                status_code=status_code,
+            )
+
+    def _error_type_of(self, method, path, status_code):
+        """Classify an error response into one of the known error types."""
+        if status_code in ("401", "403"):
+            return "auth_failed"
+        if status_code == "404":
+            return "not_found"
+        if status_code.startswith("5"):
+            return "internal"
+        if method == "POST" and path == "/":
+            return "upload_failed"
+        return "other"
+
+    def _route_of(self, path):
+        """
+        Map a request path to its route template.
+
+        The result is used as the `endpoint` label, so it has to come from
+        a small fixed set; package names are kept on the package-specific
+        metrics only.
+        """
+        if path in ("/packages", "/packages/"):
+            return "/packages/"
+        if path.startswith("/packages/"):
+            return "/packages/:file"
+        if path in ("/simple", "/simple/"):
+            return "/simple/"
+        if path.startswith("/simple/"):
+            return "/simple/:project"
+        if path in ("/", "/RPC2"):
+            return path
+        return "/other"
+
+    def _buffer_http_request(self, shard, method, endpoint, status_code, duration):
+        """Buffer an HTTP request observation, flushing once the shard is full."""
+        with self._pending_locks[shard]:
+            pending = self._pending[shard]
+            pending.add((method, endpoint, status_code), duration)
+            if pending.size < self.flush_threshold:
+                return
+            self._pending[shard] = _PendingMetrics()
+
+        self._apply_pending(pending)
+
+    def _flush_pending(self):
+        """Apply the buffered HTTP request observations of all shards."""
+        for shard, lock in enumerate(self._pending_locks):
+            with lock:
+                pending = self._pending[shard]
+                self._pending[shard] = _PendingMetrics()
+
+            self._apply_pending(pending)
+
+    def _apply_pending(self, pending):
+        """Record buffered observations, one batch per label combination."""
+        for (method, endpoint, status_code), durations in pending.durations.items():
+            self.collector.record_http_requests(
+                method=method,
+                endpoint=endpoint,
+                status_code=status_code,
+                durations=durations,
+            )
 
-    def _record_application_metrics(self, request, response, status_code):
+    def _record_application_metrics(
+            self, method, path, status_code, action, raw_filename, project, user
+    ):
         """
         Auto-detect application operations from request patterns.
 
         This method inspects requests to determine what operation occurred
         and records appropriate metrics without requiring route handler changes.
         """
-        from pypiserver.pkg_helpers import guess_pkgname_and_version
-
-        path = request.path
-        method = request.method
-
         # Detect package downloads: GET /packages/filename
         if method == "GET" and path.startswith("/packages/") and status_code == "200":
             filename = path.split("/packages/", 1)[-1].split("?")[0]
             if filename:
-                pkg_info = guess_pkgname_and_version(filename)
-                if pkg_info:
+                package_name = _cached_project_of(filename)
+                if package_name:
                     self.collector.record_download(
-                        package_name=pkg_info[0],
-                        filename=filename
+                        package_name=package_name,
+                        user=user
                     )
 
-        # Detect package uploads: POST / with :action=file_upload
+        # Detect package uploads and removals: POST / with
+        # :action=file_upload or :action=remove_pkg
         elif method == "POST" and path == "/" and status_code == "200":
-            action = request.forms.get(":action", "")
-            if action == "file_upload":
-                # Try to extract package name from the uploaded file
-                files = request.files
-                if "content" in files:
-                    uploaded_file = files.get("content")
-                    if uploaded_file:
-                        pkg_info = guess_pkgname_and_version(uploaded_file.raw_filename)
-                        if pkg_info:
-                            user = request.auth[0] if request.auth else "anonymous"
-                            self.collector.record_upload(
-                                package_name=pkg_info[0],
-                                user=user
-                            )
+            if action == "file_upload" and raw_filename:
+                package_name = _cached_project_of(raw_filename)
+                if package_name:
+                    self.collector.record_upload(
+                        package_name=package_name,
+                        user=user,
+                        filename=raw_filename,
+                    )
+            elif action == "remove_pkg" and project:
+                self.collector.record_removal(
+                    package_name=normalize_pkgname(project), user=user
+                )
+                # The number of removed files is unknown, so recount them;
+                # the walk is left to the stats thread, as it would hold up
+                # this worker for as long as it takes
+                self._stats_walk.set()
 
         # Detect searches: POST /RPC2 with search method
         elif method == "POST" and path == "/RPC2" and status_code == "200":
@@ -157,17 +461,14 @@ class MetricsPlugin:
 
         def metrics_handler():
             """Handler for Prometheus metrics endpoint."""
-            from pypiserver.bottle_wrapper import response
-
             try:
-                # Update repository counts before serving metrics
-                self._update_repository_stats()
-
-                # Generate and return metrics
-                metrics_bytes, content_type = self.collector.generate_metrics()
+                body, headers = self.metrics_response(
+                    request.headers.get("Accept-Encoding", "")
+                )
 
-                response.content_type = content_type
-                return metrics_bytes
+                for name, value in headers:
+                    response.set_header(name, value)
+                return body
             except Exception as e:
                 response.status = 500
                 response.content_type = "text/plain"
@@ -175,52 +476,193 @@ class MetricsPlugin:
 
         app.route(self.metrics_endpoint, "GET", metrics_handler)
 
+    def wsgi_middleware(self, app):
+        """
+        Wrap a WSGI application so the metrics endpoint bypasses Bottle.
+
+        GET requests to the metrics endpoint are answered straight from the
+        scrape cache, without Bottle's routing, hooks or request/response
+        objects. Everything else is passed on to `app`. The Bottle route
+        stays registered, so the endpoint keeps working without the wrapper.
+
+        Usage:
+            app.install(plugin)
+            application = plugin.wsgi_middleware(app)
+        """
+        def middleware(environ, start_response):
+            if (
+                    environ.get("PATH_INFO") != self.metrics_endpoint
+                    or environ.get("REQUEST_METHOD") != "GET"
+                    or not self.collector
+            ):
+                return app(environ, start_response)
+
+            try:
+                body, headers = self.metrics_response(
+                    environ.get("HTTP_ACCEPT_ENCODING", "")
+                )
+            except Exception:
+                # Let the Bottle handler produce the error response
+                return app(environ, start_response)
+
+            headers.append(("Content-Length", str(len(body))))
+            start_response("200 OK", headers)
+            return [body]
+
+        return middleware
+
+    def metrics_response(self, accept_encoding=""):
+        """
+        Return the (body, headers) of a metrics scrape response.
+
+        Args:
+            accept_encoding: Accept-Encoding header of the scrape request;
+                the body is gzip-compressed when it allows gzip
+        """
+        output = self._render_metrics()
+
+        headers = [
+            ("Content-Type", output.content_type),
+            ("Vary", "Accept-Encoding"),
+        ]
+        if "gzip" in accept_encoding:
+            headers.append(("Content-Encoding", "gzip"))
+            return output.gzipped(), headers
+        return output.body, headers
+
+    def _render_metrics(self):
+        """
+        Return the _ScrapeOutput served on a scrape.
+
+        The output is regenerated at most once per scrape_cache_ttl seconds.
+        Concurrent scrapes are coalesced: one of them regenerates the output
+        while the others wait on the lock and then reuse its result.
+        """
+        output = self._scrape_output
+        now = time.monotonic()
+        if output and now - output.generated_at < self.scrape_cache_ttl:
+            return output
+
+        with self._scrape_lock:
+            # Another scrape may have regenerated the output while we waited
+            output = self._scrape_output
+            now = time.monotonic()
+            if output and now - output.generated_at < self.scrape_cache_ttl:
+                return output
+
+            # Apply buffered observations before generating metrics
+            self._flush_pending()
+
+            self._scrape_output = _ScrapeOutput(*self.collector.generate_metrics())
+            return self._scrape_output
 
     def _update_repository_stats(self):
         """
         Update package and project counts from the backend.
 
         This method accesses the backend through self.config.backend
-        to retrieve current package statistics.
+        to retrieve current package statistics. It walks the whole backend,
+        so it only runs at startup and on the stats thread (after removals
+        and on the optional stats_refresh_interval); uploads update the
+        counts incrementally.
         """
         if not self.config or not self.config.backend:
             return
 
-        try:
-            # Get total package count from backend
-            package_count = len(list(self.config.backend.get_all_packages()))
-
-            # Count unique projects
-            projects = set()
-            for pkg in self.config.backend.get_all_packages():
-                projects.add(pkg.pkgname)
-            project_count = len(projects)
-
-            # Update metrics collector
-            self.collector.update_package_counts(
-                package_count=package_count,
-                project_count=project_count
-            )
-        except AttributeError as e:
-            # Handle cases where backend doesn't have expected methods
-            # This allows the plugin to work even if backend interface changes
-            pass
-        except Exception as e:
-            # Log but don't fail - metrics collection shouldn't break the server
-            import logging
-            logging.getLogger(__name__).warning(
-                f"Failed to update repository stats: {e}"
-            )
+        with self._stats_lock:
+            try:
+                # Count packages and unique projects in a single streaming
+                # pass; backend.package_count() and backend.get_projects()
+                # would each walk the whole store again
+                package_count = 0
+                projects = set()
+                # Without overwrite, pypiserver rejects re-uploads of an
+                # existing file, so every accepted upload is a new file and
+                # the file paths need not be held in memory
+                files = set() if getattr(self.config, "overwrite", False) else None
+                for pkg in self.config.backend.get_all_packages():
+                    package_count += 1
+                    projects.add(pkg.pkgname_norm)
+                    if files is not None:
+                        # Uploads are stored at the top of the first root, so
+                        # their relative path is the uploaded filename
+                        files.add(pkg.relfn_unix)
+
+                # Update metrics collector
+                self.collector.reset_repository_state(
+                    package_count=package_count,
+                    projects=projects,
+                    files=files,
+                )
+            except AttributeError as e:
+                # Handle cases where backend doesn't have expected methods
+                # This allows the plugin to work even if backend interface changes
+                pass
+            except Exception as e:
+                # Log but don't fail - metrics collection shouldn't break the server
+                logger.warning(
+                    f"Failed to update repository stats: {e}"
+                )
+
+    def _refresh_repository_stats(self):
+        """
+        Background loop re-walking the backend when a walk is requested,
+        and every stats_refresh_interval seconds to correct count drift.
+        """
+        while True:
+            self._stats_walk.wait(self.stats_refresh_interval or None)
+            if self._stats_stop.is_set():
+                return
+            # Cleared before walking, so removals during the walk are
+            # picked up by another one
+            self._stats_walk.clear()
+            self._update_repository_stats()
 
     def apply(self, callback, route):
         """
         Apply the plugin to a route (Bottle plugin API).
 
-        This method is called for each route. We don't need to wrap
-        individual routes since we use hooks for metrics collection.
+        This method is called for each route. Metrics are collected by
+        hooks; the wrapper only remembers the status of an HTTPResponse
+        returned or raised by the handler (e.g. by static_file, redirect()
+        or abort()), which Bottle applies to the response after the
+        after_request hook has run, and records crashes as 500. Raised
+        responses have to be caught here, because Bottle's JSONPlugin turns
+        them into return values before they reach the hook. A RouteReset is
+        not recorded at all, the re-dispatched request is.
         """
-        return callback
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            try:
+                out = callback(*args, **kwargs)
+            except HTTPResponse as e:
+                request._metrics_status_code = e.status_code
+                raise
+            except RouteReset:
+                request._metrics_skip = True
+                raise
+            except Exception:
+                request._metrics_status_code = 500
+                raise
+            if isinstance(out, HTTPResponse):
+                request._metrics_status_code = out.status_code
+            return out
+
+        return wrapper
 
     def close(self):
         """Clean up when plugin is uninstalled."""
-        pass
\ No newline at end of file
+        for _ in self._threads:
+            self._events.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        self._stats_stop.set()
+        self._stats_walk.set()
+        if self._stats_thread:
+            self._stats_thread.join()
+            self._stats_thread = None
+
+        if self.collector:
+            self._flush_pending()
\ No newline at end of file
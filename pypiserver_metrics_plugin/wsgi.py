@@ -11,8 +11,13 @@ app = pypiserver.app(
 )
 
 # Install metrics plugin
-app.install(MetricsPlugin(
-    metrics_endpoint=os.getenv('METRICS_ENDPOINT', '/metrics')
-))
+# Each server process only observes its own uploads, and files may be
+# added to the package directory from outside, so periodically re-walk it
+metrics_plugin = MetricsPlugin(
+    metrics_endpoint=os.getenv('METRICS_ENDPOINT', '/metrics'),
+    stats_refresh_interval=float(os.getenv('STATS_REFRESH_INTERVAL', '60')),
+)
+app.install(metrics_plugin)
 
-application = app
\ No newline at end of file
+# Serve the metrics endpoint ahead of Bottle
+application = metrics_plugin.wsgi_middleware(app)
@@ -0,0 +1,190 @@
+"""Tests for MetricsCollector."""
+
+import threading
+
+import pytest
+
+from pypiserver_metrics_plugin.collector import (
+    _HTTP_DURATION_BUCKETS,
+    MetricsCollector,
+)
+
+
+@pytest.fixture
+def collector():
+    return MetricsCollector()
+
+
+def sample(collector, name, **labels):
+    return collector.registry.get_sample_value(name, labels) or 0.0
+
+
+def test_http_request_children_are_reused(collector):
+    collector.record_http_request("GET", "/", "200", 0.1)
+    children = collector._http_req_children[("GET", "/", "200")]
+    collector.record_http_request("GET", "/", "200", 0.2)
+
+    assert collector._http_req_children[("GET", "/", "200")] is children
+    assert sample(
+        collector,
+        "pypiserver_http_requests_total",
+        method="GET",
+        endpoint="/",
+        status_code="200",
+    ) == 2
+    assert sample(
+        collector,
+        "pypiserver_http_request_duration_seconds_sum",
+        method="GET",
+        endpoint="/",
+        status_code="200",
+    ) == pytest.approx(0.3)
+
+
+def test_package_ops_share_one_counter(collector):
+    collector.record_upload("foo", "alice")
+    collector.record_upload("foo", None)
+    collector.record_upload("foo", "alice")
+    collector.record_download("foo", user="alice")
+    collector.record_removal("foo", "alice")
+
+    assert sample(
+        collector,
+        "pypiserver_package_ops_total",
+        op="upload",
+        package_name="foo",
+        principal="alice",
+    ) == 2
+    assert sample(
+        collector,
+        "pypiserver_package_ops_total",
+        op="upload",
+        package_name="foo",
+        principal="anonymous",
+    ) == 1
+    assert sample(
+        collector,
+        "pypiserver_package_ops_total",
+        op="download",
+        package_name="foo",
+        principal="alice",
+    ) == 1
+    assert sample(
+        collector,
+        "pypiserver_package_ops_total",
+        op="remove",
+        package_name="foo",
+        principal="alice",
+    ) == 1
+    assert len(collector._package_op_children) == 4
+
+
+def bucket_bounds(collector):
+    collector.record_http_request("GET", "/", "200", 0.01)
+    return [
+        bucket.labels["le"]
+        for metric in collector.registry.collect()
+        if metric.name == "pypiserver_http_request_duration_seconds"
+        for bucket in metric.samples
+        if bucket.name.endswith("_bucket")
+    ]
+
+
+def test_default_duration_buckets(collector):
+    assert isinstance(_HTTP_DURATION_BUCKETS, tuple)
+    assert bucket_bounds(collector) == [
+        "0.01", "0.05", "0.1", "0.5", "1.0", "5.0", "30.0", "+Inf"
+    ]
+
+
+def test_custom_duration_buckets():
+    assert bucket_bounds(MetricsCollector(buckets=(0.5, 2.0))) == [
+        "0.5", "2.0", "+Inf"
+    ]
+
+
+def test_unknown_error_type_is_recorded_as_other(collector):
+    collector.record_error("/", "not_found", 404)
+    collector.record_error("/", "teapot", 418)
+
+    assert sample(
+        collector,
+        "pypiserver_errors_total",
+        endpoint="/",
+        error_type="not_found",
+        status_code="404",
+    ) == 1
+    assert sample(
+        collector,
+        "pypiserver_errors_total",
+        endpoint="/",
+        error_type="other",
+        status_code="418",
+    ) == 1
+
+
+def test_upload_updates_repository_state(collector):
+    collector.reset_repository_state(1, {"foo"})
+    collector.record_upload("foo", "alice")
+    collector.record_upload("bar", "alice")
+
+    assert sample(collector, "pypiserver_packages_total") == 3
+    assert sample(collector, "pypiserver_projects_total") == 2
+
+
+def test_upload_counts_new_files_only(collector):
+    collector.reset_repository_state(1, {"foo"}, {"foo-1.0.tar.gz"})
+    collector.record_upload("foo", "alice", filename="foo-1.0.tar.gz")
+    collector.record_upload("foo", "alice", filename="foo-2.0.tar.gz")
+    collector.record_upload("bar", "alice", filename="bar-1.0.tar.gz")
+
+    assert sample(collector, "pypiserver_packages_total") == 3
+    assert sample(collector, "pypiserver_projects_total") == 2
+    assert sample(
+        collector,
+        "pypiserver_package_ops_total",
+        op="upload",
+        package_name="foo",
+        principal="alice",
+    ) == 2
+
+
+def test_upload_counts_every_file_when_files_are_not_tracked(collector):
+    collector.reset_repository_state(1, {"foo"})
+    collector.record_upload("foo", "alice", filename="foo-2.0.tar.gz")
+    collector.record_upload("foo", "alice", filename="foo-2.0.tar.gz")
+
+    assert collector._files is None
+    assert sample(collector, "pypiserver_packages_total") == 3
+
+
+def test_concurrent_uploads_are_counted_once(collector):
+    collector.reset_repository_state(0, set(), set())
+
+    def upload():
+        for i in range(500):
+            collector.record_upload(
+                f"project-{i % 50}", "alice", filename=f"file-{i}.tar.gz"
+            )
+
+    threads = [threading.Thread(target=upload) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sample(collector, "pypiserver_packages_total") == 500
+    assert sample(collector, "pypiserver_projects_total") == 50
+
+
+def test_download_accepts_filename(collector):
+    collector.record_download("foo", "foo-1.0.tar.gz")
+    collector.record_download(package_name="foo", filename="foo-1.0.tar.gz")
+
+    assert sample(
+        collector,
+        "pypiserver_package_ops_total",
+        op="download",
+        package_name="foo",
+        principal="anonymous",
+    ) == 2
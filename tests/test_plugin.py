@@ -0,0 +1,788 @@
+"""End-to-end tests driving a real pypiserver app through WSGI."""
+
+import base64
+import gzip
+import io
+import sys
+import threading
+import time
+import wsgiref.util
+
+import pypiserver
+import pytest
+from prometheus_client.parser import text_string_to_metric_families
+from pypiserver.bottle_wrapper import HTTPResponse, RouteReset
+
+from pypiserver_metrics_plugin import MetricsPlugin
+from pypiserver_metrics_plugin import plugin as plugin_module
+from pypiserver_metrics_plugin.plugin import _cached_project_of
+
+USER = "alice"
+PASSWORD = "secret"
+
+
+def call(app, method, path, body=b"", content_type="", auth=None, headers=None):
+    """Send a request to a WSGI app, returning (status, headers, body)."""
+    environ = {}
+    wsgiref.util.setup_testing_defaults(environ)
+    environ.update(
+        REQUEST_METHOD=method,
+        PATH_INFO=path,
+        CONTENT_TYPE=content_type,
+        CONTENT_LENGTH=str(len(body)),
+    )
+    environ["wsgi.input"] = io.BytesIO(body)
+    if auth:
+        token = base64.b64encode(f"{auth[0]}:{auth[1]}".encode()).decode()
+        environ["HTTP_AUTHORIZATION"] = f"Basic {token}"
+    environ.update(headers or {})
+
+    started = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        started["status"] = status
+        started["headers"] = dict(response_headers)
+
+    response_body = b"".join(app(environ, start_response))
+    return started["status"], started["headers"], response_body
+
+
+def multipart(fields, files=None):
+    """Encode a multipart/form-data body, returning (body, content_type)."""
+    boundary = "metrics-test-boundary"
+    parts = []
+    for name, field in fields.items():
+        parts.append(
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{field}\r\n".encode()
+        )
+    for name, (filename, data) in (files or {}).items():
+        parts.append(
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"; '
+            f'filename="{filename}"\r\n\r\n'.encode()
+            + data
+            + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def upload(app, filename, auth=(USER, PASSWORD)):
+    """Upload a package file, returning the response status."""
+    body, content_type = multipart(
+        {":action": "file_upload"}, {"content": (filename, b"data")}
+    )
+    return call(app, "POST", "/", body, content_type, auth=auth)[0]
+
+
+def remove(app, name, version, auth=(USER, PASSWORD)):
+    """Remove a package release, returning the response status."""
+    body, content_type = multipart(
+        {":action": "remove_pkg", "name": name, "version": version}
+    )
+    return call(app, "POST", "/", body, content_type, auth=auth)[0]
+
+
+def parse(body):
+    """Return {(sample_name, sorted_labels): value} of a metrics body."""
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(body.decode())
+        for sample in family.samples
+    }
+
+
+def value(samples, name, **labels):
+    return samples.get((name, tuple(sorted(labels.items()))), 0.0)
+
+
+def recorded(plugin):
+    """Wait for queued events and return the samples recorded so far."""
+    plugin._events.join()
+    return parse(plugin.collector.generate_metrics()[0])
+
+
+def scrape(app, plugin):
+    """Wait for queued events and return the samples served by the app."""
+    plugin._events.join()
+    return parse(call(app, "GET", "/metrics")[2])
+
+
+def package_ops(samples, op, package_name, principal="anonymous"):
+    return value(
+        samples,
+        "pypiserver_package_ops_total",
+        op=op,
+        package_name=package_name,
+        principal=principal,
+    )
+
+
+def packages_total(plugin):
+    return plugin.collector.registry.get_sample_value("pypiserver_packages_total")
+
+
+def wait_until(condition, timeout=5):
+    """Poll until condition() is true or the timeout expires."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def pending_size(plugin):
+    return sum(pending.size for pending in plugin._pending)
+
+
+def requests_total(samples, method="GET", endpoint="/", status_code="200"):
+    return value(
+        samples,
+        "pypiserver_http_requests_total",
+        method=method,
+        endpoint=endpoint,
+        status_code=status_code,
+    )
+
+
+@pytest.fixture
+def packages(tmp_path):
+    (tmp_path / "foo-1.0.tar.gz").write_bytes(b"foo")
+    return tmp_path
+
+
+@pytest.fixture
+def make_app(packages):
+    """Build a pypiserver app with the metrics plugin installed."""
+    plugins = []
+
+    def factory(overwrite=False, **kwargs):
+        app = pypiserver.app(
+            roots=[str(packages)],
+            authenticate=["update"],
+            password_file="unused",
+            auther=lambda user, password: (user, password) == (USER, PASSWORD),
+            overwrite=overwrite,
+        )
+        kwargs.setdefault("scrape_cache_ttl", 0)
+        plugin = MetricsPlugin(**kwargs)
+        app.install(plugin)
+        plugins.append(plugin)
+        return app, plugin
+
+    yield factory
+
+    for plugin in plugins:
+        plugin.close()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+class TestRecording:
+    def test_observations_are_flushed_on_scrape(self, app):
+        app, plugin = app
+        for _ in range(3):
+            call(app, "GET", "/")
+
+        # Below flush_threshold, nothing reaches the collector before a scrape
+        assert requests_total(recorded(plugin)) == 0
+        assert pending_size(plugin) == 3
+
+        samples = scrape(app, plugin)
+        assert requests_total(samples) == 3
+        assert value(
+            samples,
+            "pypiserver_http_request_duration_seconds_count",
+            method="GET",
+            endpoint="/",
+            status_code="200",
+        ) == 3
+
+    def test_observations_are_flushed_at_threshold(self, make_app):
+        app, plugin = make_app(flush_threshold=2)
+        for _ in range(3):
+            call(app, "GET", "/")
+
+        assert requests_total(recorded(plugin)) == 2
+        assert pending_size(plugin) == 1
+
+    def test_observations_without_aggregation(self, make_app):
+        app, plugin = make_app(aggregate_observations=False, workers=2)
+        for _ in range(5):
+            call(app, "GET", "/")
+
+        assert requests_total(recorded(plugin)) == 5
+        assert pending_size(plugin) == 0
+
+    def test_observations_are_buffered_per_worker(self, make_app):
+        app, plugin = make_app(workers=4)
+        for _ in range(20):
+            call(app, "GET", "/")
+        plugin._events.join()
+
+        assert len(plugin._pending) == 4
+        assert pending_size(plugin) == 20
+        assert requests_total(scrape(app, plugin)) == 20
+
+    def test_close_flushes_pending_observations(self, app):
+        app, plugin = app
+        call(app, "GET", "/")
+        plugin.close()
+
+        assert requests_total(parse(plugin.collector.generate_metrics()[0])) == 1
+
+    def test_close_stops_workers(self, make_app):
+        app, plugin = make_app(workers=2)
+        threads = list(plugin._threads)
+        plugin.close()
+
+        assert plugin._threads == []
+        assert not any(thread.is_alive() for thread in threads)
+
+    def test_events_are_dropped_when_queue_is_full(self, make_app):
+        app, plugin = make_app(workers=0, queue_size=1)
+        assert call(app, "GET", "/")[0].startswith("200")
+        assert call(app, "GET", "/")[0].startswith("200")
+        assert plugin._events.qsize() == 1
+
+    def test_duration_ignores_wall_clock_jumps(self, app, monkeypatch):
+        app, plugin = app
+        wall_clock = [1000.0]
+        monkeypatch.setattr(time, "time", lambda: wall_clock[0])
+
+        def set_clock_back():
+            wall_clock[0] = 0.0
+            return "ok"
+
+        app.route("/clock", "GET", set_clock_back)
+        call(app, "GET", "/clock")
+
+        samples = scrape(app, plugin)
+        assert 0 <= value(
+            samples,
+            "pypiserver_http_request_duration_seconds_sum",
+            method="GET",
+            endpoint="/other",
+            status_code="200",
+        ) < 1
+
+    def test_scrapes_are_not_recorded(self, app):
+        app, plugin = app
+        call(app, "GET", "/metrics")
+
+        samples = scrape(app, plugin)
+        assert not any(
+            name == "pypiserver_http_requests_total" for name, _ in samples
+        )
+        assert plugin._events.qsize() == 0
+
+    def test_custom_buckets(self, make_app):
+        app, plugin = make_app(buckets=(0.5,))
+        call(app, "GET", "/")
+
+        samples = scrape(app, plugin)
+        assert value(
+            samples,
+            "pypiserver_http_request_duration_seconds_bucket",
+            method="GET",
+            endpoint="/",
+            status_code="200",
+            le="0.5",
+        ) == 1
+        assert not any(
+            dict(labels).get("le") == "0.01" for _, labels in samples
+        )
+
+
+class TestRepositoryStats:
+    def test_counts_packages_and_projects(self, packages, make_app):
+        (packages / "foo-2.0.tar.gz").write_bytes(b"foo")
+        (packages / "bar-1.0.tar.gz").write_bytes(b"bar")
+        app, plugin = make_app()
+
+        samples = scrape(app, plugin)
+        assert value(samples, "pypiserver_packages_total") == 3
+        assert value(samples, "pypiserver_projects_total") == 2
+
+    def test_counts_are_not_walked_on_scrape(self, packages, app):
+        app, plugin = app
+        (packages / "bar-1.0.tar.gz").write_bytes(b"bar")
+
+        samples = scrape(app, plugin)
+        assert value(samples, "pypiserver_packages_total") == 1
+        assert value(samples, "pypiserver_projects_total") == 1
+
+    def test_upload_updates_counts(self, app):
+        app, plugin = app
+        assert upload(app, "foo-2.0.tar.gz").startswith("200")
+        assert upload(app, "bar-1.0.tar.gz").startswith("200")
+
+        samples = scrape(app, plugin)
+        assert value(samples, "pypiserver_packages_total") == 3
+        assert value(samples, "pypiserver_projects_total") == 2
+
+    def test_rejected_upload_leaves_counts_unchanged(self, app):
+        app, plugin = app
+        assert upload(app, "foo-1.0.tar.gz").startswith("409")
+        assert upload(app, "bar-1.0.tar.gz", auth=None).startswith("401")
+
+        samples = scrape(app, plugin)
+        assert value(samples, "pypiserver_packages_total") == 1
+        assert value(samples, "pypiserver_projects_total") == 1
+
+    def test_overwriting_upload_leaves_counts_unchanged(self, make_app):
+        app, plugin = make_app(overwrite=True)
+        assert upload(app, "foo-1.0.tar.gz").startswith("200")
+
+        samples = scrape(app, plugin)
+        assert package_ops(samples, "upload", "foo", USER) == 1
+        assert value(samples, "pypiserver_packages_total") == 1
+        assert value(samples, "pypiserver_projects_total") == 1
+
+    def test_files_are_tracked_only_with_overwrite(self, make_app):
+        app, plugin = make_app()
+        assert plugin.collector._files is None
+
+        app, plugin = make_app(overwrite=True)
+        assert plugin.collector._files == {"foo-1.0.tar.gz"}
+
+    def test_removal_recounts_repository(self, app):
+        app, plugin = app
+        assert remove(app, "foo", "1.0").startswith("200")
+
+        assert wait_until(lambda: packages_total(plugin) == 0)
+        samples = scrape(app, plugin)
+        assert package_ops(samples, "remove", "foo", USER) == 1
+        assert value(samples, "pypiserver_packages_total") == 0
+        assert value(samples, "pypiserver_projects_total") == 0
+
+    def test_requests_are_recorded_during_removal_walk(self, app, monkeypatch):
+        app, plugin = app
+        walking = threading.Event()
+        release = threading.Event()
+        update_repository_stats = plugin._update_repository_stats
+
+        def slow_update_repository_stats():
+            walking.set()
+            release.wait(5)
+            update_repository_stats()
+
+        monkeypatch.setattr(
+            plugin, "_update_repository_stats", slow_update_repository_stats
+        )
+        assert remove(app, "foo", "1.0").startswith("200")
+        assert walking.wait(5)
+
+        for _ in range(3):
+            call(app, "GET", "/")
+        joined = threading.Thread(target=plugin._events.join, daemon=True)
+        joined.start()
+        joined.join(5)
+        assert not joined.is_alive()
+        assert requests_total(scrape(app, plugin)) == 3
+        assert packages_total(plugin) == 1
+
+        release.set()
+        assert wait_until(lambda: packages_total(plugin) == 0)
+
+    def test_counts_are_refreshed_periodically(self, packages, make_app):
+        app, plugin = make_app(stats_refresh_interval=0.01)
+        assert plugin._stats_thread.is_alive()
+        (packages / "bar-1.0.tar.gz").write_bytes(b"bar")
+
+        assert wait_until(lambda: packages_total(plugin) == 2)
+
+        stats_thread = plugin._stats_thread
+        plugin.close()
+        assert not stats_thread.is_alive()
+
+    def test_projects_are_counted_by_normalized_name(self, packages, make_app):
+        (packages / "Foo_Bar-1.0.tar.gz").write_bytes(b"foo")
+        (packages / "foo-bar-2.0.tar.gz").write_bytes(b"foo")
+        app, plugin = make_app()
+        assert upload(app, "FOO.bar-3.0.tar.gz").startswith("200")
+
+        samples = scrape(app, plugin)
+        assert package_ops(samples, "upload", "foo-bar", USER) == 1
+        assert value(samples, "pypiserver_packages_total") == 4
+        assert value(samples, "pypiserver_projects_total") == 2
+
+    def test_counts_are_not_refreshed_periodically_by_default(
+            self, packages, app
+    ):
+        app, plugin = app
+        (packages / "bar-1.0.tar.gz").write_bytes(b"bar")
+
+        assert not wait_until(lambda: packages_total(plugin) == 2, timeout=0.1)
+
+        stats_thread = plugin._stats_thread
+        plugin.close()
+        assert not stats_thread.is_alive()
+
+
+class TestScrapeCache:
+    def test_output_is_reused_within_ttl(self, make_app):
+        app, plugin = make_app(scrape_cache_ttl=60)
+        first = call(app, "GET", "/metrics")[2]
+        call(app, "GET", "/")
+        plugin._events.join()
+
+        assert call(app, "GET", "/metrics")[2] == first
+
+    def test_output_is_regenerated_after_ttl(self, app):
+        app, plugin = app
+        assert requests_total(scrape(app, plugin)) == 0
+        call(app, "GET", "/")
+
+        assert requests_total(scrape(app, plugin)) == 1
+
+    def test_concurrent_scrapes_share_one_generation(self, make_app, monkeypatch):
+        app, plugin = make_app(scrape_cache_ttl=60)
+        generate_metrics = plugin.collector.generate_metrics
+        generations = []
+
+        def slow_generate_metrics():
+            generations.append(None)
+            time.sleep(0.1)
+            return generate_metrics()
+
+        monkeypatch.setattr(
+            plugin.collector, "generate_metrics", slow_generate_metrics
+        )
+
+        bodies = []
+        threads = [
+            threading.Thread(
+                target=lambda: bodies.append(call(app, "GET", "/metrics")[2])
+            )
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(generations) == 1
+        assert len(bodies) == 8
+        assert len(set(bodies)) == 1
+
+
+class TestRouteTemplates:
+    @pytest.mark.parametrize(
+        "path, endpoint",
+        [
+            ("/", "/"),
+            ("/simple/", "/simple/"),
+            ("/simple/foo/", "/simple/:project"),
+            ("/packages/", "/packages/"),
+            ("/packages/foo-1.0.tar.gz", "/packages/:file"),
+            ("/no/such/route", "/other"),
+        ],
+    )
+    def test_endpoint_label_is_route_template(self, app, path, endpoint):
+        app, plugin = app
+        call(app, "GET", path)
+
+        samples = scrape(app, plugin)
+        assert sum(
+            count
+            for (name, labels), count in samples.items()
+            if name == "pypiserver_http_requests_total"
+            and dict(labels)["endpoint"] == endpoint
+        ) == 1
+
+
+class TestErrors:
+    @pytest.mark.parametrize(
+        "path, endpoint",
+        [
+            ("/packages/missing-1.0.tar.gz", "/packages/:file"),
+            ("/no/such/route", "/other"),
+        ],
+    )
+    def test_not_found_is_recorded(self, app, path, endpoint):
+        app, plugin = app
+        assert call(app, "GET", path)[0].startswith("404")
+
+        samples = scrape(app, plugin)
+        assert requests_total(samples, endpoint=endpoint, status_code="404") == 1
+        assert value(
+            samples,
+            "pypiserver_errors_total",
+            endpoint=endpoint,
+            error_type="not_found",
+            status_code="404",
+        ) == 1
+
+    def test_redirect_status_is_recorded(self, app):
+        app, plugin = app
+        assert call(app, "GET", "/simple/foo")[0].startswith("301")
+
+        samples = scrape(app, plugin)
+        assert requests_total(
+            samples, endpoint="/simple/:project", status_code="301"
+        ) == 1
+
+    def test_crash_is_recorded_as_internal_error(self, app):
+        app, plugin = app
+
+        def crash():
+            raise ValueError("boom")
+
+        app.route("/crash", "GET", crash)
+        assert call(app, "GET", "/crash")[0].startswith("500")
+
+        samples = scrape(app, plugin)
+        assert requests_total(samples, endpoint="/other", status_code="500") == 1
+        assert value(
+            samples,
+            "pypiserver_errors_total",
+            endpoint="/other",
+            error_type="internal",
+            status_code="500",
+        ) == 1
+
+    def test_route_reset_is_recorded_once(self, app):
+        app, plugin = app
+        attempts = []
+
+        def reset():
+            attempts.append(None)
+            if len(attempts) == 1:
+                raise RouteReset()
+            return "ok"
+
+        app.route("/reset", "GET", reset)
+        assert call(app, "GET", "/reset")[0].startswith("200")
+
+        samples = scrape(app, plugin)
+        assert len(attempts) == 2
+        assert requests_total(samples, endpoint="/other") == 1
+        assert requests_total(samples, endpoint="/other", status_code="500") == 0
+        assert not any(
+            name == "pypiserver_errors_total" and value
+            for (name, labels), value in samples.items()
+        )
+
+    @pytest.mark.parametrize(
+        "filename, auth, status_code, error_type",
+        [
+            ("foo-1.0.tar.gz", (USER, PASSWORD), "409", "upload_failed"),
+            ("not-a-package.txt", (USER, PASSWORD), "400", "upload_failed"),
+            ("bar-1.0.tar.gz", None, "401", "auth_failed"),
+        ],
+    )
+    def test_rejected_upload_is_recorded(
+            self, app, filename, auth, status_code, error_type
+    ):
+        app, plugin = app
+        assert upload(app, filename, auth=auth).startswith(status_code)
+
+        samples = scrape(app, plugin)
+        assert requests_total(
+            samples, method="POST", status_code=status_code
+        ) == 1
+        assert value(
+            samples,
+            "pypiserver_errors_total",
+            endpoint="/",
+            error_type=error_type,
+            status_code=status_code,
+        ) == 1
+        assert not any(
+            name == "pypiserver_package_ops_total" for name, _ in samples
+        )
+
+    def test_failed_removal_is_not_counted(self, app):
+        app, plugin = app
+        assert remove(app, "missing", "1.0").startswith("404")
+
+        samples = scrape(app, plugin)
+        assert requests_total(
+            samples, method="POST", status_code="404"
+        ) == 1
+        assert not any(
+            name == "pypiserver_package_ops_total" for name, _ in samples
+        )
+
+    def test_uncommon_status_is_recorded(self, app):
+        app, plugin = app
+        app.route("/teapot", "GET", lambda: HTTPResponse(status=418))
+        assert call(app, "GET", "/teapot")[0].startswith("418")
+
+        samples = scrape(app, plugin)
+        assert requests_total(samples, endpoint="/other", status_code="418") == 1
+        assert value(
+            samples,
+            "pypiserver_errors_total",
+            endpoint="/other",
+            error_type="other",
+            status_code="418",
+        ) == 1
+
+    def test_download_of_missing_file_is_not_counted(self, app):
+        app, plugin = app
+        call(app, "GET", "/packages/missing-1.0.tar.gz")
+
+        samples = scrape(app, plugin)
+        assert not any(
+            name == "pypiserver_package_ops_total" for name, _ in samples
+        )
+
+
+class TestPackageOperations:
+    @pytest.mark.parametrize(
+        "auth, principal", [(None, "anonymous"), ((USER, PASSWORD), USER)]
+    )
+    def test_download(self, app, auth, principal):
+        app, plugin = app
+        call(app, "GET", "/packages/foo-1.0.tar.gz", auth=auth)
+
+        samples = scrape(app, plugin)
+        assert package_ops(samples, "download", "foo", principal) == 1
+
+    def test_repeated_downloads_parse_filename_once(self, app):
+        app, plugin = app
+        _cached_project_of.cache_clear()
+        for _ in range(3):
+            call(app, "GET", "/packages/foo-1.0.tar.gz")
+
+        samples = scrape(app, plugin)
+        assert package_ops(samples, "download", "foo") == 3
+        assert _cached_project_of.cache_info().misses == 1
+
+    def test_upload(self, app):
+        app, plugin = app
+        assert upload(app, "bar-1.0.tar.gz").startswith("200")
+
+        samples = scrape(app, plugin)
+        assert package_ops(samples, "upload", "bar", USER) == 1
+
+    def test_form_of_other_posts_is_not_parsed(self, app, monkeypatch):
+        app, plugin = app
+        forms = type(plugin_module.request).forms
+        forms_read = []
+
+        def spy(request):
+            # pypiserver parses its own forms; only count reads by the plugin
+            if sys._getframe(1).f_code.co_filename == plugin_module.__file__:
+                forms_read.append(True)
+            return forms.__get__(request, type(request))
+
+        monkeypatch.setattr(type(plugin_module.request), "forms", property(spy))
+        status = call(
+            app,
+            "POST",
+            "/",
+            b'{":action": "file_upload"}',
+            "application/json",
+            auth=(USER, PASSWORD),
+        )[0]
+        plugin._events.join()
+
+        assert status.startswith("400")
+        assert forms_read == []
+
+
+class TestMetricsEndpoint:
+    @pytest.fixture(params=["bottle", "middleware"])
+    def endpoint_app(self, request, app):
+        """The app serving scrapes through the Bottle route or the middleware."""
+        app, plugin = app
+        if request.param == "middleware":
+            return plugin.wsgi_middleware(app), plugin
+        return app, plugin
+
+    def test_plain_response(self, endpoint_app):
+        app, plugin = endpoint_app
+        status, headers, body = call(app, "GET", "/metrics")
+
+        assert status.startswith("200")
+        assert headers["Content-Type"].startswith("text/plain")
+        assert headers["Vary"] == "Accept-Encoding"
+        assert "Content-Encoding" not in headers
+        assert ("pypiserver_packages_total", ()) in parse(body)
+
+    def test_gzip_response(self, endpoint_app):
+        app, plugin = endpoint_app
+        status, headers, body = call(
+            app, "GET", "/metrics", headers={"HTTP_ACCEPT_ENCODING": "gzip"}
+        )
+
+        assert status.startswith("200")
+        assert headers["Content-Encoding"] == "gzip"
+        assert headers["Vary"] == "Accept-Encoding"
+        assert ("pypiserver_packages_total", ()) in parse(gzip.decompress(body))
+
+    def test_gzip_body_is_compressed_once(self, make_app):
+        app, plugin = make_app(scrape_cache_ttl=60)
+        gzip_headers = {"HTTP_ACCEPT_ENCODING": "gzip"}
+        first = call(app, "GET", "/metrics", headers=gzip_headers)[2]
+        compressed = plugin._scrape_output.gzipped()
+
+        assert call(app, "GET", "/metrics", headers=gzip_headers)[2] == first
+        assert plugin._scrape_output.gzipped() is compressed
+
+    def test_metrics_response(self, make_app):
+        app, plugin = make_app(scrape_cache_ttl=60)
+        body, headers = plugin.metrics_response()
+        gzip_body, gzip_headers = plugin.metrics_response("gzip, deflate")
+
+        assert dict(headers)["Vary"] == "Accept-Encoding"
+        assert "Content-Encoding" not in dict(headers)
+        assert dict(gzip_headers)["Content-Encoding"] == "gzip"
+        assert gzip.decompress(gzip_body) == body
+
+    def test_middleware_serves_scrapes_ahead_of_bottle(self, app):
+        app, plugin = app
+
+        def unreachable(environ, start_response):
+            raise AssertionError("scrape was passed on to the app")
+
+        middleware = plugin.wsgi_middleware(unreachable)
+        status, headers, body = call(middleware, "GET", "/metrics")
+
+        assert status.startswith("200")
+        assert headers["Content-Length"] == str(len(body))
+
+    def test_middleware_passes_other_requests_to_app(self, app):
+        app, plugin = app
+        middleware = plugin.wsgi_middleware(app)
+
+        assert call(middleware, "GET", "/packages/foo-1.0.tar.gz")[2] == b"foo"
+        assert call(middleware, "POST", "/metrics")[0].startswith("405")
+        assert requests_total(scrape(app, plugin), endpoint="/packages/:file") == 1
+
+    def test_middleware_falls_back_to_bottle_on_error(self, app, monkeypatch):
+        app, plugin = app
+        middleware = plugin.wsgi_middleware(app)
+
+        def broken_metrics_response(accept_encoding=""):
+            raise ValueError("broken")
+
+        monkeypatch.setattr(plugin, "metrics_response", broken_metrics_response)
+        status, headers, body = call(middleware, "GET", "/metrics")
+
+        assert status.startswith("500")
+        assert b"broken" in body
+
+    def test_conflicting_endpoint_starts_no_threads(self, packages):
+        app = pypiserver.app(roots=[str(packages)])
+        app.route("/metrics", "GET", lambda: "taken")
+        hooks = {name: list(funcs) for name, funcs in app._hooks.items()}
+        plugin = MetricsPlugin(stats_refresh_interval=0.01)
+
+        with pytest.raises(RuntimeError, match="overlaps"):
+            app.install(plugin)
+
+        assert plugin._threads == []
+        assert plugin._stats_thread is None
+        assert not any(
+            thread.name.startswith("pypiserver-metrics")
+            for thread in threading.enumerate()
+        )
+        assert {name: list(funcs) for name, funcs in app._hooks.items()} == hooks
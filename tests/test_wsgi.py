@@ -0,0 +1,44 @@
+"""Tests for the WSGI entry point."""
+
+import importlib
+import sys
+import time
+
+import pytest
+
+
+@pytest.fixture
+def load_wsgi(tmp_path, monkeypatch):
+    """Import pypiserver_metrics_plugin.wsgi with the given environment."""
+    modules = []
+
+    def load(**env):
+        monkeypatch.setenv("PACKAGES_DIR", str(tmp_path))
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        sys.modules.pop("pypiserver_metrics_plugin.wsgi", None)
+        module = importlib.import_module("pypiserver_metrics_plugin.wsgi")
+        modules.append(module)
+        return module
+
+    yield load
+
+    for module in modules:
+        module.metrics_plugin.close()
+    sys.modules.pop("pypiserver_metrics_plugin.wsgi", None)
+
+
+def test_repository_stats_are_refreshed_by_default(load_wsgi):
+    wsgi = load_wsgi()
+
+    assert wsgi.metrics_plugin.stats_refresh_interval == 60
+    assert wsgi.metrics_plugin._stats_thread.is_alive()
+
+
+def test_repository_stats_refresh_can_be_disabled(load_wsgi, tmp_path):
+    wsgi = load_wsgi(STATS_REFRESH_INTERVAL="0")
+    (tmp_path / "foo-1.0.tar.gz").write_bytes(b"foo")
+    time.sleep(0.1)
+
+    registry = wsgi.metrics_plugin.collector.registry
+    assert registry.get_sample_value("pypiserver_packages_total") == 0